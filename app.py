@@ -2,63 +2,291 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from google.generativeai import GenerativeModel
 import google.generativeai as genai
+from google.api_core.exceptions import TooManyRequests
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from typing import List, Optional, Set, Dict
+import msgspec
+from typing import Any, Callable, List, TypedDict, Optional, Set, Dict, Tuple, Deque
 import os
+import glob
+import time
 import random
-import json
+import orjson
 from urllib.parse import unquote
-from threading import Thread
+from threading import Thread, Lock, RLock, BoundedSemaphore
 import re
 import asyncio
-from functools import wraps
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, Counter, deque
 
 app = Flask(__name__)
 CORS(app)
-load_dotenv()
+load_dotenv(override=False)
 
 # Configuration
+# All settings are read once at import; nothing on the request path touches os.environ
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-genai.configure(api_key=GEMINI_API_KEY)
+if not GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY is not set; add it to the environment or .env")
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'grpc')
+USE_LLM_CONCEPT_EXTRACTION = os.getenv('USE_LLM_CONCEPT_EXTRACTION', 'false').lower() == 'true'
+# Chapters longer than this are also uploaded through the Files API, so later
+# refills can reference the full text without re-sending it
+INLINE_CONTENT_LIMIT = int(os.getenv('INLINE_CONTENT_LIMIT', '32000'))
+# Upper bound on Gemini calls in flight at once per process
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))
+# Steady-state Gemini requests per minute per process; 0 disables the limit
+GEMINI_RPM_LIMIT = int(os.getenv('GEMINI_RPM_LIMIT', '60'))
+FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
+BOOKS_DIR = os.getenv('BOOKS_DIR', '/home/ubuntu/schoolbookstxt')
+BOOKS_ROOT = os.path.realpath(BOOKS_DIR)
+PRELOAD_BOOKS = os.getenv('PRELOAD_BOOKS', 'true').lower() == 'true'
+PRELOAD_WORKERS = int(os.getenv('PRELOAD_WORKERS', '32'))
+# Longest a request thread waits for question generation before giving up
+GENERATION_TIMEOUT = float(os.getenv('GENERATION_TIMEOUT', '90'))
+
+# Configured once per process; the models below share the SDK's client instead
+# of creating one per request. GEMINI_TRANSPORT can switch it to 'rest'.
+genai.configure(api_key=GEMINI_API_KEY, transport=GEMINI_TRANSPORT)
 model = GenerativeModel('gemini-2.0-flash-exp')
 
 # Constants
 TEST_MODE_QUESTIONS = 25
 PRACTICE_MODE_QUESTIONS_PER_SET = 5
+# Practice questions are generated several sets at a time to amortize each LLM call
+PRACTICE_MODE_BATCH_SIZE = 20
 HARD_QUESTION_PERCENTAGE = 70
+QUESTION_CACHE_PARTITIONS = 256
+USED_QUESTIONS_LIMIT = 10_000
+GENERATION_CACHE_SIZE = 512
+# Generated batches kept per request tuple for replay to later quiz sessions
+GENERATION_CACHE_BATCHES = 4
+KEY_CONCEPT_COUNT = 30
+# Gemini deletes uploaded files after 48 hours; re-upload a little before that
+UPLOADED_FILE_TTL = 47 * 60 * 60
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_RETRY_INITIAL_DELAY = 0.5
+GEMINI_RETRY_MAX_DELAY = 8.0
+# Threads available to asyncio.to_thread for blocking SDK calls and file IO
+EVENT_LOOP_WORKERS = 64
+
+CONCEPT_WORD_RE = re.compile(r"[a-z][a-z'-]*[a-z]")
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been
+before being below between both but by can could did do does doing down during each
+few for from further had has have having he her here hers herself him himself his how
+i if in into is it its itself just let me more most my myself no nor not now of off on
+once only or other our ours ourselves out over own same she should so some such than
+that the their theirs them themselves then there these they this those through to too
+under until up upon very was we were what when where which while who whom why will
+with would you your yours yourself yourselves called may many much one two three used
+use using like well within without
+""".split())
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts')
+
+def load_prompt(name: str) -> str:
+    with open(os.path.join(PROMPTS_DIR, f"{name}.txt"), 'r', encoding='utf-8') as file:
+        return file.read().strip()
+
+# Static rubrics are sent as system instructions so the provider can reuse
+# the cached prefix; each request only carries the variable content prompt.
+TEST_MODE_PROMPT = load_prompt('test_mode')
+PRACTICE_MODE_PROMPT = load_prompt('practice_mode')
+KEY_CONCEPTS_PROMPT = load_prompt('key_concepts')
+
+class QuizQuestionSchema(TypedDict):
+    question: str
+    options: List[str]
+    answer: str
+    explanation: str
+
+class QuizResponseSchema(TypedDict):
+    questions: List[QuizQuestionSchema]
 
-class QuizQuestion(BaseModel):
+# JSON mode makes Gemini return output that parses as-is, with no cleanup pass
+QUIZ_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=QuizResponseSchema
+)
+
+test_model = GenerativeModel('gemini-2.0-flash-exp', system_instruction=TEST_MODE_PROMPT, generation_config=QUIZ_GENERATION_CONFIG)
+practice_model = GenerativeModel('gemini-2.0-flash-exp', system_instruction=PRACTICE_MODE_PROMPT, generation_config=QUIZ_GENERATION_CONFIG)
+
+class QuizQuestion(msgspec.Struct, frozen=True):
     question: str
     options: List[str]
     answer: str
+    answer_index: int
     explanation: str
 
 # Global variables
-question_cache: List[QuizQuestion] = []
-used_questions: Set[str] = set()
+# Pending questions partitioned by (standard, subject, chapter, topic, is_practice_mode)
+question_cache: "OrderedDict[Tuple, Deque[QuizQuestion]]" = OrderedDict()
+# Insertion-ordered so the oldest questions can be evicted once over the limit
+used_questions: "OrderedDict[str, None]" = OrderedDict()
 current_topic: str = ""
 file_content_cache: Dict[str, str] = {}
 concept_cache: Dict[str, str] = {}
 processed_files: Set[str] = set()
+file_mtime_cache: Dict[str, float] = {}
+# file path -> (file mtime, upload time, Gemini file handle); kept across cache clears
+uploaded_file_cache: Dict[str, Tuple[float, float, Any]] = {}
+# Per-file locks so concurrent requests never upload the same book twice
+upload_locks: Dict[str, Lock] = {}
+# Generated batches by (standard, subject, chapter, topic, is_practice_mode); kept
+# apart from used_questions so a later session can be served without Gemini
+generation_cache: "OrderedDict[Tuple, List[List[QuizQuestion]]]" = OrderedDict()
+# How many cached batches the current session of each partition has been served
+replayed_batches: Dict[Tuple, int] = {}
+# Background refills in flight, by partition
+prefetch_futures: Dict[Tuple, Future] = {}
+# Guards every cache above; Flask serves requests on multiple threads and
+# preloading fills the file caches in the background
+cache_lock = RLock()
+gemini_semaphore = BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+# Token bucket for GEMINI_RPM_LIMIT: [available tokens, last refill time]
+gemini_rate_bucket = [float(GEMINI_RPM_LIMIT), time.monotonic()]
+gemini_rate_lock = Lock()
+
+# One event loop for the whole process, run on a background thread; request
+# threads submit coroutines to it instead of creating a loop per request
+event_loop = asyncio.new_event_loop()
+event_loop.set_default_executor(ThreadPoolExecutor(max_workers=EVENT_LOOP_WORKERS))
+Thread(target=event_loop.run_forever, daemon=True).start()
+
+def get_question_queue(cache_key: Tuple) -> Deque[QuizQuestion]:
+    with cache_lock:
+        queue = question_cache.get(cache_key)
+        if queue is None:
+            queue = question_cache[cache_key] = deque()
+        question_cache.move_to_end(cache_key)
+        while len(question_cache) > QUESTION_CACHE_PARTITIONS:
+            question_cache.popitem(last=False)
+        return queue
+
+def start_generation_session(cache_key: Tuple):
+    with cache_lock:
+        if cache_key in generation_cache:
+            replayed_batches[cache_key] = 0
+
+def take_cached_batch(cache_key: Tuple) -> Optional[List[QuizQuestion]]:
+    with cache_lock:
+        batches = generation_cache.get(cache_key)
+        replayed = replayed_batches.get(cache_key, 0)
+        if not batches or replayed >= len(batches):
+            return None
+        generation_cache.move_to_end(cache_key)
+        replayed_batches[cache_key] = replayed + 1
+        return batches[replayed]
+
+def store_generated_batch(cache_key: Tuple, questions: List[QuizQuestion]):
+    with cache_lock:
+        batches = generation_cache.setdefault(cache_key, [])
+        generation_cache.move_to_end(cache_key)
+        if len(batches) < GENERATION_CACHE_BATCHES:
+            batches.append(list(questions))
+        # This session already has every cached batch, including the new one
+        replayed_batches[cache_key] = len(batches)
+        while len(generation_cache) > GENERATION_CACHE_SIZE:
+            old_key, _ = generation_cache.popitem(last=False)
+            replayed_batches.pop(old_key, None)
+
+def mark_question_used(question_text: str) -> bool:
+    with cache_lock:
+        if question_text in used_questions:
+            return False
+        used_questions[question_text] = None
+        while len(used_questions) > USED_QUESTIONS_LIMIT:
+            used_questions.popitem(last=False)
+        return True
+
+def run_async(coro, timeout: float = GENERATION_TIMEOUT) -> Any:
+    future = asyncio.run_coroutine_threadsafe(coro, event_loop)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # Frees the request thread; a blocking SDK call already running in the
+        # executor still finishes in the background
+        future.cancel()
+        raise
+
+def acquire_gemini_rate_token():
+    if GEMINI_RPM_LIMIT <= 0:
+        return
+    while True:
+        with gemini_rate_lock:
+            now = time.monotonic()
+            tokens, updated = gemini_rate_bucket
+            tokens = min(GEMINI_RPM_LIMIT, tokens + (now - updated) * GEMINI_RPM_LIMIT / 60)
+            if tokens >= 1:
+                gemini_rate_bucket[:] = [tokens - 1, now]
+                return
+            gemini_rate_bucket[:] = [tokens, now]
+            wait = (1 - tokens) * 60 / GEMINI_RPM_LIMIT
+        time.sleep(wait)
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    # gRPC transport: the server's google.rpc.RetryInfo is among the parsed details
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    # REST transport: the HTTP response carries a Retry-After header
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
 
-def async_to_sync(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
-    return wrapper
+def call_gemini(func: Callable[[], Any]) -> Any:
+    delay = GEMINI_RETRY_INITIAL_DELAY
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        try:
+            acquire_gemini_rate_token()
+            with gemini_semaphore:
+                return func()
+        except TooManyRequests as e:
+            if attempt == GEMINI_MAX_ATTEMPTS:
+                raise
+            wait = get_retry_after(e) or delay + random.uniform(0, delay)
+            print(f"Gemini rate limited (attempt {attempt}/{GEMINI_MAX_ATTEMPTS}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            delay = min(delay * 2, GEMINI_RETRY_MAX_DELAY)
+
+def extract_local_concepts(text_content: str) -> str:
+    words = CONCEPT_WORD_RE.findall(text_content.lower())
+    counts = Counter(word for word in words if len(word) > 3 and word not in STOPWORDS)
+    bigrams = Counter(
+        f"{first} {second}" for first, second in zip(words, words[1:])
+        if first not in STOPWORDS and second not in STOPWORDS
+    )
+    # Repeated phrases are stronger signals than single words
+    counts.update({phrase: count * 2 for phrase, count in bigrams.items() if count > 1})
+    return ", ".join(term for term, _ in counts.most_common(KEY_CONCEPT_COUNT))
 
 def extract_key_concepts(text_content: str) -> str:
     print("\nExtracting key concepts from text content...")
-    prompt = """Extract and summarize the key concepts and important points from this text. 
-    Include only the most essential information needed for generating questions later.
-    Keep it concise but comprehensive."""
-    
-    response = model.generate_content(f"{prompt}\n\nText: {text_content}")
+    if not USE_LLM_CONCEPT_EXTRACTION:
+        concepts = extract_local_concepts(text_content)
+        print("Successfully extracted key concepts locally")
+        return concepts
+
+    response = call_gemini(lambda: model.generate_content(f"{KEY_CONCEPTS_PROMPT}\n\nText: {text_content}"))
     concepts = response.text.strip()
     print("Successfully extracted key concepts")
     return concepts
 
+def generate_text(quiz_model: GenerativeModel, prompt: Any) -> str:
+    def stream() -> str:
+        response = quiz_model.generate_content(prompt, stream=True)
+        return "".join(chunk.text for chunk in response).strip()
+
+    # The stream is consumed inside the guard so the whole call holds one slot
+    return call_gemini(stream)
+
 def print_question(q: QuizQuestion, index: int):
     print(f"\nQuestion {index}:")
     print("=" * 50)
@@ -66,137 +294,180 @@ def print_question(q: QuizQuestion, index: int):
     print("\nOptions:")
     for i, opt in enumerate(q.options):
         print(f"{chr(65+i)}) {opt}")
-    print(f"\nCorrect Answer: {q.answer}")
+    print(f"\nCorrect Answer: {chr(65+q.answer_index)}) {q.answer}")
     print(f"Explanation: {q.explanation}")
     print("-" * 50)
 
 def read_and_process_content(file_path: str) -> Optional[str]:
     try:
-        print(f"\nReading and processing file: {file_path}")
+        mtime = os.stat(file_path).st_mtime
+        with cache_lock:
+            if file_path in file_content_cache and file_mtime_cache.get(file_path) == mtime:
+                return file_content_cache[file_path]
+
+        print(f"\nReading file: {file_path}")
         with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()
-            key_concepts = extract_key_concepts(content)
-            concept_cache[file_path] = key_concepts
+        # Content, mtime and concepts change together so they never disagree
+        with cache_lock:
+            concept_cache.pop(file_path, None)
             file_content_cache[file_path] = content
-            print("Successfully processed file and extracted concepts")
-            return content
+            file_mtime_cache[file_path] = mtime
+        return content
     except Exception as e:
         print(f"Error processing file {file_path}: {str(e)}")
         return None
 
+def is_file_cached(file_path: str, cache_key: Tuple) -> bool:
+    if file_path not in processed_files:
+        return False
+    try:
+        mtime = os.stat(file_path).st_mtime
+    except OSError:
+        mtime = None
+    if file_mtime_cache.get(file_path) == mtime:
+        return True
+    print(f"\nFile changed since it was processed: {file_path}")
+    with cache_lock:
+        processed_files.discard(file_path)
+        file_content_cache.pop(file_path, None)
+        concept_cache.pop(file_path, None)
+        file_mtime_cache.pop(file_path, None)
+        # Queued questions were generated from the old text; drop every
+        # chapter and mode partition built from this book
+        standard, subject, _, topic, _ = cache_key
+        for key in [key for key in question_cache if (key[0], key[1], key[3]) == (standard, subject, topic)]:
+            del question_cache[key]
+        for key in [key for key in generation_cache if (key[0], key[1], key[3]) == (standard, subject, topic)]:
+            del generation_cache[key]
+            replayed_batches.pop(key, None)
+    return False
+
+def resolve_book_path(standard: str, subject: str, topic: str) -> Optional[str]:
+    # Query arguments can hold absolute paths or '..'; only allow files under BOOKS_ROOT
+    try:
+        file_path = os.path.realpath(os.path.join(BOOKS_ROOT, standard, subject, f"{topic}.txt"))
+    except ValueError:
+        # e.g. an embedded NUL byte
+        return None
+    if os.path.commonpath([file_path, BOOKS_ROOT]) != BOOKS_ROOT:
+        return None
+    return file_path
+
+def get_cached_upload(file_path: str) -> Any:
+    with cache_lock:
+        cached = uploaded_file_cache.get(file_path)
+        if cached and cached[0] == file_mtime_cache.get(file_path) and time.time() - cached[1] < UPLOADED_FILE_TTL:
+            return cached[2]
+    return None
+
+def get_uploaded_file(file_path: str) -> Any:
+    with cache_lock:
+        upload_lock = upload_locks.setdefault(file_path, Lock())
+    with upload_lock:
+        mtime = os.stat(file_path).st_mtime
+        with cache_lock:
+            cached = uploaded_file_cache.get(file_path)
+        if cached and cached[0] == mtime and time.time() - cached[1] < UPLOADED_FILE_TTL:
+            return cached[2]
+
+        print(f"\nUploading large file to Gemini: {file_path}")
+        uploaded = call_gemini(lambda: genai.upload_file(path=file_path, mime_type='text/plain'))
+        with cache_lock:
+            uploaded_file_cache[file_path] = (mtime, time.time(), uploaded)
+        return uploaded
+
+def try_upload_file(file_path: str) -> Any:
+    try:
+        return get_uploaded_file(file_path)
+    except Exception as e:
+        print(f"Error uploading file {file_path}: {str(e)}")
+        return None
+
+def process_key_concepts(file_path: str, content: str) -> Optional[str]:
+    with cache_lock:
+        if file_path in concept_cache:
+            return concept_cache[file_path]
+    try:
+        key_concepts = extract_key_concepts(content)
+        with cache_lock:
+            # The file may have been re-read or invalidated meanwhile
+            if file_content_cache.get(file_path) is not content:
+                return None
+            concept_cache[file_path] = key_concepts
+        print("Successfully processed file and extracted concepts")
+        return key_concepts
+    except Exception as e:
+        print(f"Error extracting concepts from {file_path}: {str(e)}")
+        return None
+
 def calculate_accuracy(text_content: str, questions: List[QuizQuestion]) -> float:
     try:
-        total_words = len(text_content.split())
-        relevant_count = 0
-        for q in questions:
-            question_words = q.question.lower().split()
-            for word in question_words:
-                if len(word) > 3 and word in text_content.lower():
-                    relevant_count += 1
+        text_words = {word for word in text_content.lower().split() if len(word) > 3}
+        relevant_count = sum(
+            1 for q in questions for word in q.question.lower().split()
+            if len(word) > 3 and word in text_words
+        )
         accuracy = min((relevant_count / (len(questions) * 2)) * 100, 100)
         return round(accuracy, 2)
     except Exception as e:
         print(f"Error calculating accuracy: {str(e)}")
         return 0.0
 
-async def generate_quiz_questions(text_content: str = None, topic: str = None, concepts: str = None, is_practice_mode: bool = True) -> Optional[List[QuizQuestion]]:
+def build_questions(raw_questions: List[dict]) -> List[QuizQuestion]:
+    processed_questions = []
+    for q in raw_questions:
+        if not all(k in q for k in ["question", "options", "answer", "explanation"]):
+            continue
+            
+        if len(q["options"]) != 4:
+            continue
+            
+        if q["question"] in used_questions:
+            continue
+
+        cleaned_question = {
+            "question": q["question"].strip(),
+            "options": [opt.strip() for opt in q["options"]],
+            "answer": q["answer"].strip(),
+            "explanation": q["explanation"].strip()
+        }
+
+        try:
+            options = cleaned_question["options"]
+            if cleaned_question["answer"] not in options:
+                continue
+
+            # Shuffle before building the model so the answer index is final
+            random.shuffle(options)
+            cleaned_question["answer_index"] = options.index(cleaned_question["answer"])
+            question = msgspec.convert(cleaned_question, QuizQuestion)
+
+            if not mark_question_used(question.question):
+                continue
+
+            processed_questions.append(question)
+            print_question(question, len(processed_questions))
+        except Exception as e:
+            print(f"Error creating question object: {str(e)}")
+            continue
+
+    return processed_questions
+
+async def generate_quiz_questions(text_content: str = None, topic: str = None, concepts: str = None, is_practice_mode: bool = True, content_file: Any = None) -> Optional[List[QuizQuestion]]:
     print("\nGenerating Questions...")
     print("=" * 50)
     print(f"Mode: {'Practice' if is_practice_mode else 'Test'}")
-    print(f"Source: {'Text File' if text_content else 'Concepts' if concepts else 'Topic only'}")
+    print(f"Source: {'Uploaded File' if content_file else 'Text File' if text_content else 'Concepts' if concepts else 'Topic only'}")
 
     try:
-        num_questions = TEST_MODE_QUESTIONS if not is_practice_mode else PRACTICE_MODE_QUESTIONS_PER_SET
-
-        if not is_practice_mode:
-            enhanced_prompt = """Generate extremely challenging multiple choice questions that test advanced cognitive abilities. Questions should be:
-
-            Question Distribution:
-            1. Complex logical reasoning (40%)
-               - Multi-step deductive reasoning
-               - Advanced pattern recognition
-               - Abstract concept application
-            
-            2. Advanced critical thinking (60%)
-               - Deep analysis requirements
-               - Complex problem evaluation
-               - Multi-perspective consideration
-            
-            3. Multi-step problem solving (60%)
-               - Sophisticated computational thinking
-               - Strategic solution planning
-               - Advanced concept integration
-
-            Requirements:
-            - All questions must be at the highest difficulty level
-            - Questions should challenge even advanced learners
-            - Clear and unambiguous despite complexity
-            - Each question should require deep understanding
-            - Include detailed explanations for learning
-
-            Format Requirements:
-            - 4 distinct options per question
-            - One definitively correct answer
-            - Comprehensive explanation (40 words)
-            - Crystal clear question structure
-
-            Response Format (JSON):
-            {
-                "questions": [
-                    {
-                        "question": "Question text",
-                        "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
-                        "answer": "Correct option text",
-                        "explanation": "Detailed explanation"
-                    }
-                ]
-            }"""
-        else:
-            enhanced_prompt = """Generate a balanced mix of multiple choice questions with varying difficulty levels:
+        num_questions = TEST_MODE_QUESTIONS if not is_practice_mode else PRACTICE_MODE_BATCH_SIZE
 
-            Question Distribution:
-            1. Hard questions (100%)
-               - Complex reasoning
-               - Advanced problem-solving
-               - Deep conceptual understanding
-            
-            2. Intermediate questions (100%)
-               - Applied knowledge
-               - Basic analysis
-               - Concept integration
-            
-            3. Basic questions (1000%)
-               - Fundamental concepts
-               - Direct application
-               - Core understanding
-
-            Requirements:
-            - Progressive difficulty level
-            - Clear learning progression
-            - Balanced concept coverage
-            - Appropriate challenge level
-            - Helpful explanations for learning
-
-            Format Requirements:
-            - 4 distinct options per question
-            - One definitively correct answer
-            - Clear explanation (40 words)
-            - Well-structured questions
-
-            Response Format (JSON):
-            {
-                "questions": [
-                    {
-                        "question": "Question text",
-                        "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
-                        "answer": "Correct option text",
-                        "explanation": "Detailed explanation"
-                    }
-                ]
-            }"""
-
-        if text_content:
-            content_prompt = f"Using this content:\n{text_content}\n\nGenerate {num_questions} questions that follow the guidelines above."
+        if content_file:
+            content_prompt = [content_file, f"Using the attached content, generate {num_questions} questions that follow your guidelines."]
+            print("Using uploaded file for generation")
+        elif text_content:
+            content_prompt = f"Using this content:\n{text_content}\n\nGenerate {num_questions} questions that follow your guidelines."
             print("Using full text content for generation")
         elif concepts:
             content_prompt = f"""Generate {num_questions} questions about {topic} using these key concepts:
@@ -205,60 +476,22 @@ async def generate_quiz_questions(text_content: str = None, topic: str = None, c
             Ensure questions are based on these concepts while maintaining variety and appropriate difficulty."""
             print("Using extracted concepts for generation")
         else:
-            content_prompt = f"Generate {num_questions} questions about {topic} that follow the guidelines above."
+            content_prompt = f"Generate {num_questions} questions about {topic} that follow your guidelines."
             print("Using topic only for generation")
 
-        full_prompt = f"{enhanced_prompt}\n\n{content_prompt}"
+        quiz_model = test_model if not is_practice_mode else practice_model
+        # The SDK call blocks, so run it off the event loop to let concurrent
+        # work (e.g. concept extraction) overlap with it.
+        response_text = await asyncio.to_thread(generate_text, quiz_model, content_prompt)
 
-        response = model.generate_content(full_prompt)
-        response_text = response.text.strip()
-        
-        json_text = re.search(r'({[\s\S]*})', response_text)
-        if not json_text:
-            raise ValueError("No valid JSON found in response")
-            
-        cleaned_json = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', json_text.group(1))
-        cleaned_json = re.sub(r',(\s*[}\]])', r'\1', cleaned_json)
-        
         try:
-            response_data = json.loads(cleaned_json)
-        except json.JSONDecodeError as e:
+            response_data = orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
             print(f"JSON Parse Error: {str(e)}")
-            print(f"Problematic JSON: {cleaned_json}")
+            print(f"Problematic JSON: {response_text}")
             raise
         
-        processed_questions = []
-        for q in response_data.get("questions", []):
-            if not all(k in q for k in ["question", "options", "answer", "explanation"]):
-                continue
-                
-            if len(q["options"]) != 4:
-                continue
-                
-            if q["question"] in used_questions:
-                continue
-
-            cleaned_question = {
-                "question": q["question"].strip(),
-                "options": [opt.strip() for opt in q["options"]],
-                "answer": q["answer"].strip(),
-                "explanation": q["explanation"].strip()
-            }
-
-            try:
-                question = QuizQuestion(**cleaned_question)
-
-                if question.answer not in question.options:
-                    continue
-
-                random.shuffle(question.options)
-                used_questions.add(question.question)
-                processed_questions.append(question)
-                print_question(question, len(processed_questions))
-            except Exception as e:
-                print(f"Error creating question object: {str(e)}")
-                continue
-
+        processed_questions = build_questions(response_data.get("questions", []))
         print(f"\nSuccessfully processed {len(processed_questions)} questions")
         return processed_questions
 
@@ -266,78 +499,182 @@ async def generate_quiz_questions(text_content: str = None, topic: str = None, c
         print(f"Error in generate_quiz_questions: {str(e)}")
         return None
 
+async def refill_question_queue(cache_key: Tuple, file_path: str, topic: str, is_practice_mode: bool) -> Optional[List[QuizQuestion]]:
+    # Runs first so an edited book evicts its cached batches before replay
+    file_cached = is_file_cached(file_path, cache_key)
+
+    cached_batch = take_cached_batch(cache_key)
+    if cached_batch:
+        print(f"\nReplaying {len(cached_batch)} cached questions...")
+        with cache_lock:
+            get_question_queue(cache_key).extend(cached_batch)
+        return cached_batch
+
+    # is_file_cached already stats processed files, so os.path.exists only runs for unseen ones
+    if file_cached:
+        content_file = get_cached_upload(file_path)
+        if content_file:
+            print("\nUsing uploaded file...")
+            questions = await generate_quiz_questions(
+                topic=topic,
+                is_practice_mode=is_practice_mode,
+                content_file=content_file
+            )
+        else:
+            print("\nUsing cached concepts...")
+            with cache_lock:
+                concepts = concept_cache.get(file_path)
+            questions = await generate_quiz_questions(
+                topic=topic,
+                concepts=concepts,
+                is_practice_mode=is_practice_mode
+            )
+    elif file_path in file_content_cache or os.path.exists(file_path):
+        print("\nProcessing new file content...")
+        # Keep disk reads off the shared event loop
+        chapter_content = await asyncio.to_thread(read_and_process_content, file_path)
+        generation = generate_quiz_questions(
+            text_content=chapter_content,
+            topic=topic,
+            is_practice_mode=is_practice_mode
+        )
+        if chapter_content:
+            # Concepts and the upload are only needed by later refills, so run
+            # them alongside question generation instead of before it.
+            background = [asyncio.to_thread(process_key_concepts, file_path, chapter_content)]
+            if len(chapter_content) > INLINE_CONTENT_LIMIT:
+                background.append(asyncio.to_thread(try_upload_file, file_path))
+            questions, concepts, *_ = await asyncio.gather(generation, *background)
+            # Only mark the file processed once its concepts are stored, so
+            # concurrent requests never take the concepts branch without them
+            if concepts:
+                with cache_lock:
+                    processed_files.add(file_path)
+        else:
+            questions = await generation
+    else:
+        print("\nGenerating questions from topic only...")
+        questions = await generate_quiz_questions(
+            topic=topic,
+            is_practice_mode=is_practice_mode
+        )
+
+    if questions:
+        store_generated_batch(cache_key, questions)
+        with cache_lock:
+            get_question_queue(cache_key).extend(questions)
+    return questions
+
+def json_response(payload: dict, status: int = 200):
+    # msgspec encodes QuizQuestion structs straight to bytes, skipping Flask's stdlib json encoder
+    return app.response_class(msgspec.json.encode(payload), status=status, mimetype='application/json')
+
+def start_prefetch(cache_key: Tuple, file_path: str, topic: str, is_practice_mode: bool):
+    def on_done(future):
+        with cache_lock:
+            if prefetch_futures.get(cache_key) is future:
+                del prefetch_futures[cache_key]
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Error prefetching questions: {str(future.exception())}")
+
+    with cache_lock:
+        if cache_key in prefetch_futures:
+            return
+        print("\nPrefetching next batch of questions...")
+        future = asyncio.run_coroutine_threadsafe(
+            refill_question_queue(cache_key, file_path, topic, is_practice_mode),
+            event_loop
+        )
+        prefetch_futures[cache_key] = future
+    future.add_done_callback(on_done)
+
+def wait_for_prefetch(cache_key: Tuple, timeout: float):
+    with cache_lock:
+        future = prefetch_futures.get(cache_key)
+    if future is None:
+        return
+    print("\nWaiting for in-flight prefetch...")
+    try:
+        future.result(timeout=timeout)
+    except Exception as e:
+        print(f"Error waiting for prefetch: {repr(e)}")
+
 @app.route('/quiz/next', methods=['GET'])
-@async_to_sync
-async def get_next_questions():
+def get_next_questions():
     try:
-        topic = unquote(request.args.get('topic', ''))
         current_index = int(request.args.get('current_index', 0))
-        standard = request.args.get('standard', '')
-        subject = request.args.get('subject', '')
-        chapter = request.args.get('chapter', '')
         is_practice_mode = request.args.get('is_practice_mode', 'true').lower() == 'true'
-        
-        if not topic:
-            return jsonify({"error": "Missing topic parameter"}), 400
 
-        topic = topic.strip()
-        
         if not is_practice_mode and current_index >= TEST_MODE_QUESTIONS:
-            return jsonify({
+            return json_response({
                 "questions": [],
                 "should_fetch": False,
                 "total_questions": TEST_MODE_QUESTIONS
             })
 
+        topic = unquote(request.args.get('topic', ''))
+        if not topic:
+            return json_response({"error": "Missing topic parameter"}, 400)
+
+        topic = topic.strip()
+        standard = request.args.get('standard', '').strip()
+        subject = request.args.get('subject', '').strip()
+        chapter = request.args.get('chapter', '').strip()
+
+        file_path = resolve_book_path(standard, subject, topic)
+        if file_path is None:
+            return json_response({"error": "Invalid standard, subject or topic parameter"}, 400)
+
         questions_per_set = PRACTICE_MODE_QUESTIONS_PER_SET if is_practice_mode else TEST_MODE_QUESTIONS
 
-        if len(question_cache) < questions_per_set:
-            file_path = rf"/home/ubuntu/schoolbookstxt/{standard}/{subject}/{topic}.txt"
-            
-            if os.path.exists(file_path):
-                if file_path not in processed_files:
-                    print("\nProcessing new file content...")
-                    chapter_content = read_and_process_content(file_path)
-                    processed_files.add(file_path)
-                    questions = await generate_quiz_questions(
-                        text_content=chapter_content,
-                        is_practice_mode=is_practice_mode
-                    )
-                else:
-                    print("\nUsing cached concepts...")
-                    concepts = concept_cache.get(file_path)
-                    questions = await generate_quiz_questions(
-                        topic=topic,
-                        concepts=concepts,
-                        is_practice_mode=is_practice_mode
-                    )
-            else:
-                print("\nGenerating questions from topic only...")
-                questions = await generate_quiz_questions(
-                    topic=topic,
-                    is_practice_mode=is_practice_mode
-                )
-                
-            if questions is None or len(questions) == 0:
-                return jsonify({"error": "Failed to generate questions"}), 500
-                
-            question_cache.extend(questions)
-
-        questions_to_send = question_cache[:questions_per_set]
-        del question_cache[:questions_per_set]
+        # Same case as the file path, so distinct files never share a partition
+        cache_key = (standard, subject, chapter, topic, is_practice_mode)
+        if current_index == 0:
+            # A new quiz may replay batches an earlier session generated
+            start_generation_session(cache_key)
+        queue = get_question_queue(cache_key)
+
+        # One deadline covers both the prefetch wait and our own refill
+        deadline = time.monotonic() + GENERATION_TIMEOUT
+
+        if len(queue) < questions_per_set:
+            # A prefetch for this partition may already be generating the next
+            # batch; wait for it rather than starting a second Gemini call
+            wait_for_prefetch(cache_key, GENERATION_TIMEOUT)
+            queue = get_question_queue(cache_key)
+
+        if len(queue) < questions_per_set:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                raise FutureTimeoutError()
+            questions = run_async(refill_question_queue(cache_key, file_path, topic, is_practice_mode), time_left)
+            if not questions:
+                return json_response({"error": "Failed to generate questions"}, 500)
+
+        with cache_lock:
+            queue = get_question_queue(cache_key)
+            questions_to_send = [queue.popleft() for _ in range(min(questions_per_set, len(queue)))]
+            remaining = len(queue)
+
+        # Refill in the background while the student works through this set
+        if is_practice_mode and remaining < 2 * questions_per_set:
+            start_prefetch(cache_key, file_path, topic, is_practice_mode)
 
         if not questions_to_send:
-            return jsonify({"error": "No questions available"}), 500
+            return json_response({"error": "No questions available"}, 500)
 
-        return jsonify({
-            "questions": [q.model_dump() for q in questions_to_send],
+        return json_response({
+            "questions": questions_to_send,
             "should_fetch": True if is_practice_mode else current_index + len(questions_to_send) < TEST_MODE_QUESTIONS,
             "total_questions": TEST_MODE_QUESTIONS if not is_practice_mode else -1
         })
 
+    except FutureTimeoutError:
+        print(f"Timed out generating questions after {GENERATION_TIMEOUT}s")
+        return json_response({"error": "Timed out generating questions"}, 504)
     except Exception as e:
         print(f"Error in get_next_questions: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -345,26 +682,54 @@ def health_check():
 
 @app.route('/quiz/clear-cache', methods=['GET'])
 def clear_cache():
-    global question_cache, used_questions, file_content_cache, concept_cache, processed_files
-    question_cache.clear()
-    used_questions.clear()
-    file_content_cache.clear()
-    concept_cache.clear()
-    processed_files.clear()
+    global question_cache, used_questions, file_content_cache, concept_cache, processed_files, generation_cache
+    with cache_lock:
+        question_cache.clear()
+        used_questions.clear()
+        file_content_cache.clear()
+        concept_cache.clear()
+        processed_files.clear()
+        file_mtime_cache.clear()
+        generation_cache.clear()
+        replayed_batches.clear()
     print("\nAll caches cleared")
     return jsonify({"status": "Caches cleared"}), 200
 
 @app.route('/quiz/status', methods=['GET'])
 def get_status():
     return jsonify({
-        "cache_size": len(question_cache),
+        "cache_size": sum(len(queue) for queue in list(question_cache.values())),
         "used_questions": len(used_questions),
         "file_cache_size": len(file_content_cache),
         "concept_cache_size": len(concept_cache),
         "processed_files": len(processed_files),
+        "generation_cache_size": len(generation_cache),
         "current_topic": current_topic
     }), 200
 
+def preload_file(file_path: str):
+    # Runs while requests are served; both helpers write the caches under cache_lock
+    content = read_and_process_content(file_path)
+    # LLM extraction would cost one Gemini call per book on every boot, so
+    # those concepts are left to the first request instead
+    if content and not USE_LLM_CONCEPT_EXTRACTION:
+        process_key_concepts(file_path, content)
+
+def preload_book_files():
+    # Resolved the same way as request paths so cache keys match
+    paths = [os.path.realpath(path) for path in glob.glob(os.path.join(BOOKS_ROOT, '**', '*.txt'), recursive=True)]
+    paths = [path for path in paths if os.path.commonpath([path, BOOKS_ROOT]) == BOOKS_ROOT]
+    if not paths:
+        return
+    print(f"\nPreloading {len(paths)} book files from {BOOKS_ROOT}...")
+    with ThreadPoolExecutor(max_workers=PRELOAD_WORKERS) as executor:
+        list(executor.map(preload_file, paths))
+    print("Finished preloading book files")
+
+# Warm the file caches without holding up server startup
+if PRELOAD_BOOKS:
+    Thread(target=preload_book_files, daemon=True).start()
+
 if __name__ == '__main__':
     print("\nStarting Quiz Generator Server...")
     print(f"Test Mode Questions: {TEST_MODE_QUESTIONS}")
@@ -373,4 +738,5 @@ if __name__ == '__main__':
     print("=" * 50)
     
     CORS(app, resources={r"/": {"origins": ""}})
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    # Development server only; run `gunicorn app:app` in production
+    app.run(debug=FLASK_DEBUG, port=5000, host='0.0.0.0')
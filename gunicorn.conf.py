@@ -0,0 +1,11 @@
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+# Question queues and used-question tracking live in process memory, so keep a
+# single worker by default and scale with threads; requests are IO-bound.
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+# Generation calls can take tens of seconds
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+keepalive = 5